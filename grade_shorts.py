@@ -21,9 +21,15 @@ OUTPUTS:
 """
 
 
+import io
+import itertools
 import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import decode_source
+from operator import itemgetter
+from pathlib import Path
 
 import pandas as pd
 from fpdf import FPDF
@@ -65,76 +71,146 @@ def create_template_pdf(
     template.output(filename)
 
 
-def find_all_violations(
-    scores: pd.DataFrame, rules: dict[str, list[RuleChecker]], code_dir: str
-) -> dict[str, dict[str, list[RuleViolation]]]:
+def _check_student(
+    files: dict[str, bytes], rules: dict[str, tuple[RuleChecker, ...]]
+) -> dict[str, list[RuleViolation]]:
     """
-    Iterates through student code in the `code_dir` to find violations of the `rules`.
-    `rules` maps problem names to a list of RuleCheckers, each called to visit the
-    syntax tree and return any violations.
+    Finds the violations in one student's `files`, mapping each problem file name
+    to its code, of the `rules` (already combined with the universal rules for
+    each problem). Runs in a worker process.
 
-    Updates `scores` to reflect 0 points for any questions with violated rules.
-
-    Returns a dict containing the rule violations for each student:
-        {NETID -> {PROBLEM -> list[RuleViolation]}}
+    Returns {PROBLEM FILE -> list[RuleViolation]}
     """
-    violations = {}
-
-    for netid_dir in os.listdir(code_dir):
-        netid = os.path.basename(netid_dir)
-        netid_dir = os.path.join(code_dir, netid_dir)
-        assignments = sorted(os.listdir(netid_dir))
+    return {
+        problem_file: find_violations(code, rules[problem_file.removesuffix(".py")])
+        for problem_file, code in files.items()
+    }
 
-        for problem_file in assignments:
-            problem_name = problem_file.removesuffix(".py")
-            problem_rules = rules["universal"] + rules[problem_name]
-            problem_filepath = os.path.join(netid_dir, problem_file)
 
-            code = open(problem_filepath).read()
-            problem_violations = find_violations(code, problem_rules)
-            violations.setdefault(netid, {})
-            violations[netid][problem_name] = problem_violations
+def _source_lines(code: bytes) -> list[str]:
+    """
+    Decodes the source `code` as Python would and splits it into lines. Only CRLF,
+    CR and LF end a line, as for the AST's line numbers (str.splitlines also breaks
+    on form feeds, U+2028, ...). Code with a bad coding cookie or invalid bytes is
+    decoded as UTF-8 with replacement characters instead.
+    """
+    try:
+        text = decode_source(code)
+    except (SyntaxError, UnicodeDecodeError):
+        text = code.decode("utf-8", errors="replace")
+    lines = io.StringIO(text, newline=None).read().split("\n")
+    # A final newline ends the last line rather than starting an empty one
+    if lines[-1] == "":
+        lines.pop()
+    return lines
 
-            if len(problem_violations) != 0:
-                print(f"VIOLATION FOUND IN {problem_file} FOR {netid}{RED}")
-                print(*problem_violations, RESET, sep='\n')
-                # If any violations found, score is 0
-                scores.at[netid, f"{problem_name} passed"] = 0
 
-    return violations
+def find_all_violations(
+    scores: pd.DataFrame,
+    rules: dict[str, tuple[RuleChecker, ...]],
+    code_dir: str,
+) -> tuple[
+    dict[str, dict[str, list[RuleViolation]]], dict[tuple[str, str], list[str]]
+]:
+    """
+    Iterates through student code in the `code_dir` to find violations of the `rules`.
+    `rules` maps problem names to a tuple of RuleCheckers, which are checked
+    against the syntax tree to find any violations. Students are checked in parallel
+    across a pool of processes.
 
+    Updates `scores` to reflect 0 points for any questions with violated rules,
+    with one assignment per problem column once all code has been checked.
 
-def add_code_to_pdf(pdf: FPDF, code_file: str, violations: list[RuleViolation]) -> None:
+    Returns a dict containing the rule violations for each student:
+        {NETID -> {PROBLEM -> list[RuleViolation]}}
+    and a dict with the lines of each code file, so it only needs to be read once:
+        {(NETID, PROBLEM) -> list[str]}
     """
-    Adds the lines in `code_file` to `pdf`; any lines in `violations` highlighted red.
+    violations = {}
+    code_lines = {}
+    zero_updates: list[tuple[str, str]] = []
+    submissions: dict[str, dict[str, bytes]] = {}
+
+    with os.scandir(code_dir) as netid_entries:
+        for netid_entry in netid_entries:
+            if not netid_entry.is_dir(follow_symlinks=False):
+                continue
+            netid = netid_entry.name
+            with os.scandir(netid_entry.path) as problem_entries:
+                assignments = sorted(problem_entries, key=lambda entry: entry.name)
+
+            files = submissions[netid] = {}
+            for problem_entry in assignments:
+                problem_file = problem_entry.name
+                problem_name = problem_file.removesuffix(".py")
+                code = Path(problem_entry.path).read_bytes()
+                files[problem_file] = code
+                code_lines[netid, problem_name] = _source_lines(code)
+
+    # Each problem is checked against its own rules plus the universal ones
+    combined_rules = {
+        problem: rules["universal"] + problem_rules
+        for problem, problem_rules in rules.items()
+    }
+    with ProcessPoolExecutor() as executor:
+        futures = {
+            netid: executor.submit(_check_student, files, combined_rules)
+            for netid, files in submissions.items()
+        }
+        for netid, future in futures.items():
+            for problem_file, problem_violations in future.result().items():
+                problem_name = problem_file.removesuffix(".py")
+                violations.setdefault(netid, {})
+                violations[netid][problem_name] = problem_violations
+
+                if len(problem_violations) != 0:
+                    print(f"VIOLATION FOUND IN {problem_file} FOR {netid}{RED}")
+                    print(*problem_violations, RESET, sep='\n')
+                    # If any violations found, score is 0
+                    zero_updates.append((netid, problem_name))
+
+    zero_updates.sort(key=itemgetter(1))
+    for problem_name, updates in itertools.groupby(zero_updates, key=itemgetter(1)):
+        netids = scores.index.intersection([netid for netid, _ in updates])
+        scores.loc[netids, f"{problem_name} passed"] = 0
+
+    return violations, code_lines
+
+
+def add_code_to_pdf(pdf: FPDF, lines: list[str], violations: list[RuleViolation]) -> None:
     """
-    lines = open(code_file).readlines()
+    Adds the code `lines` to `pdf`; any lines in `violations` highlighted red.
 
-    violation_lines = [v.line_num for v in violations]
-    for i, line in enumerate(lines[:28], 1):
-        if i in violation_lines:
+    Consecutive lines of the same color are written as one multi_cell block.
+    """
+    violation_lines = {v.line_num for v in violations}
+    numbered = [
+        (i in violation_lines, f"{i:2}| {line}") for i, line in enumerate(lines[:28], 1)
+    ]
+    for in_violation, run in itertools.groupby(numbered, key=itemgetter(0)):
+        if in_violation:
             pdf.set_text_color(255, 0, 0)
         else:
             pdf.set_text_color(0, 0, 0)
-        pdf.cell(400, 6, txt=f"{i:2}| {line}", ln=i, align="L")
+        pdf.multi_cell(400, 6, txt="\n".join(line for _, line in run), align="L")
 
-    pdf.set_text_color(255, 0, 0)
-    for i, v in enumerate(violations, 28):
-        pdf.cell(400, 6, txt=str(v), ln=i, align="L")
+    if violations:
+        pdf.set_text_color(255, 0, 0)
+        pdf.multi_cell(400, 6, txt="\n".join(map(str, violations)), align="L")
 
 
 def create_score_pdf(
     scores: pd.DataFrame,
     problem_list: list[str],
     violations: dict[str, dict[str, list[RuleViolation]]],
-    code_dir: str,
+    code_lines: dict[tuple[str, str], list[str]],
     ignore_ids: set[str],
     name_map: dict[str, str],
     filename: str,
 ) -> None:
     """
     Outputs a pdf containing the scores for each student in the `scores`. Includes
-    the problems in the order of `problem_list`, and includes code from the `code_dir`.
+    the problems in the order of `problem_list`, and includes code from `code_lines`.
     Uses `violations` to highlight in red lines where students violated rules.
 
     Ignores any netids in `ignore_ids`, and uses names in the `name_map` where applicable.
@@ -144,14 +220,21 @@ def create_score_pdf(
     pdf = FPDF()
     pdf.set_font("Courier", size=10)
 
-    for netid, row in scores.iterrows():
+    # Pull each column out once as an array, indexed by row position below
+    netids = scores.index.to_numpy()
+    firstnames = scores["Firstname"].to_numpy()
+    lastnames = scores["Lastname"].to_numpy()
+    passed = {p: scores[f"{p} passed"].to_numpy() for p in problem_list}
+    cases = {p: scores[f"{p} cases"].to_numpy() for p in problem_list}
+
+    for i, netid in enumerate(netids):
         if netid in ignore_ids:
             continue
 
         if netid in name_map:
             name = name_map[netid]
         else:
-            name = f"{row['Firstname']} {row['Lastname']}"
+            name = f"{firstnames[i]} {lastnames[i]}"
 
         pdf.add_page()
         pdf.set_text_color(0, 0, 0)
@@ -164,14 +247,13 @@ def create_score_pdf(
             pdf.set_text_color(0, 0, 0)
             pdf.add_page()
 
-            points = row[f"{problem} passed"]
-            max_points = row[f"{problem} cases"]
+            points = passed[problem][i]
+            max_points = cases[problem][i]
             score_line = f"{problem} score: {points} / {max_points} |  {netid}"
             pdf.cell(10, 10, txt=score_line, ln=1, align="L")
-            codefile = os.path.join(code_dir, netid, problem + ".py")
-            if os.path.exists(codefile):
+            if (netid, problem) in code_lines:
                 problem_violations = violations[netid][problem]
-                add_code_to_pdf(pdf, codefile, problem_violations)
+                add_code_to_pdf(pdf, code_lines[netid, problem], problem_violations)
 
     pdf.output(filename)
 
@@ -223,11 +305,27 @@ def get_config(filename: str) -> tuple[dict[str, str], set[str]]:
         config = json.load(file)
 
     name_map = config["name_map"]
-    ignored_ids = set(config["ignored_ids"])
+    ignored_ids = {sys.intern(netid) for netid in config["ignored_ids"]}
 
     return name_map, ignored_ids
 
 
+def read_scores(csv_file: str, problem_list: list[str]) -> pd.DataFrame:
+    """
+    Reads the scores in `csv_file`, indexed by netid. Only loads the name columns
+    and the passed/cases columns for each problem in `problem_list`, as integers.
+    """
+    score_columns = [f"{p} {kind}" for p in problem_list for kind in ("passed", "cases")]
+    scores = pd.read_csv(
+        csv_file,
+        usecols=["netid", "Firstname", "Lastname", *score_columns],
+        # Nullable, since scores are blank for students with no submission
+        dtype={column: "Int32" for column in score_columns},
+    ).set_index("netid")
+    scores.index = pd.CategoricalIndex(scores.index.map(sys.intern))
+    return scores
+
+
 def main():
     try:
         input_dir, csv_file, code_dir, aup_file = get_args(sys.argv)
@@ -240,15 +338,15 @@ def main():
     rules = parse_file(aup_file)
     problems = sorted(rules.keys())
     problems.remove("universal")
-    df = pd.read_csv(csv_file).set_index("netid")
+    df = read_scores(csv_file, problems)
 
     template_path = os.path.join(input_dir, "gradescope_template.pdf")
     full_pdf_path = os.path.join(input_dir, "gradescope_output.pdf")
 
     create_template_pdf(df, problems, template_path)
-    violations = find_all_violations(df, rules, code_dir)
+    violations, code_lines = find_all_violations(df, rules, code_dir)
     create_score_pdf(
-        df, problems, violations, code_dir, ignored_ids, name_map, full_pdf_path,
+        df, problems, violations, code_lines, ignored_ids, name_map, full_pdf_path,
     )
 
     print(f"{GREEN}{BOLD}template PDF saved to `{template_path}`")
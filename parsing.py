@@ -6,7 +6,7 @@ DESCRIPTION:
     Module containing the parsing logic for aup files.
 
 FUNCTION:
-    `parse_file(filename: str) -> dict[str, list[RuleChecker]]`
+    `parse_file(filename: str) -> dict[str, tuple[RuleChecker, ...]]`
 
 USAGE:
     python3 parsing.py
@@ -15,47 +15,66 @@ USAGE:
 """
 
 
-from icecream import ic
+from pathlib import Path
+from typing import Callable
 
 from rules import FunctionRule, MethodRule, NodeRule, RuleChecker, RuleType
 
 
-def parse_file(filename: str) -> dict[str, list[RuleChecker]]:
+# Constructor of a RuleChecker, given its RuleType and the name of its target
+_RuleFactory = Callable[[RuleType, str], RuleChecker]
+
+# Maps the first two words of a rule line to the RuleChecker it creates
+_RULE_DISPATCH: dict[tuple[str, str], tuple[_RuleFactory, RuleType]] = {
+    ("require", "node"): (NodeRule, RuleType.REQUIRE),
+    ("ban", "node"): (NodeRule, RuleType.BAN),
+    ("require", "function"): (FunctionRule, RuleType.REQUIRE),
+    ("ban", "function"): (FunctionRule, RuleType.BAN),
+    ("require", "method"): (MethodRule, RuleType.REQUIRE),
+    ("ban", "method"): (MethodRule, RuleType.BAN),
+}
+
+
+def parse_file(filename: str) -> dict[str, tuple[RuleChecker, ...]]:
     """
     Parses `filename`, a .aup file.
-    Returns a dictionary mapping each problem name to the list of RuleChecker
+    Returns a dictionary mapping each problem name to the tuple of RuleChecker
     corresponding to the problem, as outlined in the aup file.
+
+    Identical rules (e.g. the same ban in several problems) share one RuleChecker.
     """
-    rules = {}
+    rules: dict[str, list[RuleChecker]] = {}
+    interned: dict[tuple[_RuleFactory, RuleType, str], RuleChecker] = {}
     cur_problem = "universal"
     rules[cur_problem] = []
-    for line in open(filename):
-        match line.split():
-            case [] | ["#", *_]:
-                continue
-            case ["problem", problem_name]:
-                cur_problem = problem_name
-                if cur_problem not in rules:
-                    rules[cur_problem] = []
-            case ["require", "node", node_name]:
-                rules[cur_problem].append(NodeRule(RuleType.REQUIRE, node_name))
-            case ["ban", "node", node_name]:
-                rules[cur_problem].append(NodeRule(RuleType.BAN, node_name))
-            case ["require", "function", function_name]:
-                rules[cur_problem].append(FunctionRule(RuleType.REQUIRE, function_name))
-            case ["ban", "function", function_name]:
-                rules[cur_problem].append(FunctionRule(RuleType.BAN, function_name))
-            case ["require", "method", method_name]:
-                rules[cur_problem].append(MethodRule(RuleType.REQUIRE, method_name))
-            case ["ban", "method", method_name]:
-                rules[cur_problem].append(MethodRule(RuleType.BAN, method_name))
-            case _:
-                print(f"UNKNOWN line found: {line}")
-
-    return rules
+    for line in Path(filename).read_text().splitlines():
+        tokens = line.split()
+        if not tokens or tokens[0] == "#":
+            continue
+
+        if len(tokens) == 2 and tokens[0] == "problem":
+            cur_problem = tokens[1]
+            if cur_problem not in rules:
+                rules[cur_problem] = []
+            continue
+
+        handler = _RULE_DISPATCH.get((tokens[0], tokens[1])) if len(tokens) == 3 else None
+        if handler is None:
+            print(f"UNKNOWN line found: {line}")
+            continue
+        rule_class, ruletype = handler
+        key = (rule_class, ruletype, tokens[2])
+        if key not in interned:
+            interned[key] = rule_class(ruletype, tokens[2])
+        rules[cur_problem].append(interned[key])
+
+    return {problem: tuple(problem_rules) for problem, problem_rules in rules.items()}
 
 
 def main():
+    # Only needed for the demo, and slow to import
+    from icecream import ic
+
     filename = input("enter filename to parse: ")
     rules = parse_file(filename)
     ic(rules)
@@ -8,34 +8,46 @@ DESCRIPTION:
 
 CLASSES:
     - `RuleType(Enum)`: RuleType.BAN and RuleType.REQUIRE.
-    - `RuleViolation`: dataclass to keep track of which/where rules are violated.
-    - `RuleChecker(ast.NodeVisitor)`: Keeps track of a syntax rule by visiting AST
+    - `RuleViolation(NamedTuple)`: Keeps track of which/where rules are violated.
+    - `RuleChecker`: Immutable description of a syntax rule to check an AST for
         - `NodeRule(RuleChecker)`: Bans/requires a type of AST node.
         - `FunctionRule(RuleChecker)`: Bans/requires a particular function call.
         - `MethodRule(RuleChecker)`: Bans/requires a particular method call.
 
 FUNCTIONS:
-    - `get_violations(code: str, rules: list[RuleChecker]) -> list[RuleViolation]`
+    - `format_violation(violation: RuleViolation) -> str`
+    - `find_violations(code: str | bytes, rules: Sequence[RuleChecker])
+        -> list[RuleViolation]`
+    - `find_violations_batch(files: Sequence[str], rules: Sequence[RuleChecker])
+        -> dict[str, list[RuleViolation]]`
 
 USAGE:
-    python3 rules.py
+    python3 rules.py [FILE ...]
 
-    When run as a script, prompts to enter a filename, and checks that file 
+    When run as a script, checks the given files (or prompts to enter a filename)
     with the list of examples RuleCheckers in main, printing results.
 """
 
 
 import ast
+import functools
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import Optional
-from dataclasses import dataclass
+from typing import Any, NamedTuple, Optional, Sequence
+from dataclasses import dataclass, field
 
-from icecream import ic
+import numpy as np
 
 # ANSI escape codes
 RED = "\033[91m"
 RESET = "\033[0m"
 
+# Set the AU_DEBUG environment variable to dump results with icecream in main
+DEBUG = __debug__ and bool(os.getenv("AU_DEBUG"))
+
 
 class RuleType(Enum):
     """Rules can either BAN something, or REQUIRE it. Used for RuleCheckers."""
@@ -44,8 +56,7 @@ class RuleType(Enum):
     BAN = "Ban"
 
 
-@dataclass(slots=True)
-class RuleViolation:
+class RuleViolation(NamedTuple):
     """Keeps track of rule violated, line num and corresponding line if applicable."""
 
     rule: str
@@ -53,141 +64,367 @@ class RuleViolation:
     line: Optional[str] = None
 
     def __str__(self) -> str:
-        if not self.line_num and not self.line:
-            return f"rule {self.rule} not fulfilled"
+        return format_violation(self)
+
 
-        s = f"rule {self.rule} violated"
-        if self.line_num:
-            s += f" on line {self.line_num}"
-        if self.line:
-            s += f": `{self.line}`"
-        return s
+def format_violation(violation: RuleViolation) -> str:
+    """Returns the message describing `violation`."""
+    match violation.line_num, violation.line:
+        case None, None:
+            return f"rule {violation.rule} not fulfilled"
+        case line_num, None:
+            return f"rule {violation.rule} violated on line {line_num}"
+        case None, line:
+            return f"rule {violation.rule} violated: `{line}`"
+        case line_num, line:
+            return f"rule {violation.rule} violated on line {line_num}: `{line}`"
 
 
-class RuleChecker(ast.NodeVisitor):
+@dataclass(frozen=True, slots=True)
+class RuleChecker:
     """
-    A RuleChecker is a kind of NodeVisitor that keeps track of whether it has found
-    a particular function call / type of node / etc. as it visits each node
-    in the AST (Abstract Syntax Tree).
+    A RuleChecker describes a syntax rule: a particular function call / type of node
+    / etc. that is banned from, or required in, the AST (Abstract Syntax Tree).
+
+    RuleCheckers are immutable and hashable. `find_violations` keeps track of where
+    each rule is found as it walks a tree, so the same rules can be shared between
+    files and worker processes, and used as dict keys.
 
-    The general logic for whether a rule has been violated is below, and each
-    subclass will contain specific logic by overriding the various visit* methods
-    of a NodeVisitor.
+    The general logic for whether a rule has been violated is below; subclasses
+    add the target of the rule, which `find_violations` matches against nodes.
     """
 
-    def __init__(self, ruletype: RuleType):
-        self.ruletype = ruletype
-        self.found_location = None
+    ruletype: RuleType
+    is_ban: bool = field(init=False, repr=False, compare=False)
+    _desc: str = field(init=False, repr=False, compare=False)
 
-    def reset(self):
-        """Resets the status of the RuleChecker to check a new file."""
-        self.found_location = None
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "is_ban", self.ruletype is RuleType.BAN)
+        object.__setattr__(self, "_desc", self._describe())
 
-    def get_violation(self) -> Optional[RuleViolation]:
-        """Returns the violation found by this RuleChecker, or None."""
-        if self.ruletype is RuleType.BAN:
-            rule_followed = not self.found_location
+    def _describe(self) -> str:
+        """Returns the description of this rule, computed once and cached in `_desc`."""
+        return self.ruletype.value
+
+    def __str__(self) -> str:
+        return self._desc
+
+    def __repr__(self) -> str:
+        return self._desc
+
+    def get_violation(self, found_location: Optional[int]) -> Optional[RuleViolation]:
+        """
+        Returns the violation of this rule, given the line it was first
+        `found_location` (None if not found), or None if the rule was followed.
+        """
+        if self.is_ban:
+            rule_followed = found_location is None
         else:
-            rule_followed = self.found_location
+            rule_followed = found_location is not None
 
         if rule_followed:
             return None
         else:
-            return RuleViolation(str(self), self.found_location)
+            return RuleViolation(self._desc, found_location)
 
 
+@dataclass(frozen=True, slots=True, repr=False)
 class MethodRule(RuleChecker):
-    """RuleChecker that keeps track of calls to a particular `method`."""
+    """RuleChecker for calls to a particular `method`."""
 
-    def __init__(self, ruletype: RuleType, method: str):
-        super().__init__(ruletype)
-        self.method = method
+    method: str
 
-    # Overrides ast.NodeVisitor.visit_Attribute
-    def visit_Attribute(self, node):
-        if node.attr == self.method:
-            self.found_location = node.lineno
-        super().visit(node.value)
+    def __post_init__(self) -> None:
+        # Shares one string with equal names (pickling to a worker makes a new copy)
+        object.__setattr__(self, "method", sys.intern(self.method))
+        RuleChecker.__post_init__(self)
 
-    def __str__(self) -> str:
+    def _describe(self) -> str:
         return f"{self.ruletype.value}MethodCall({self.method})"
 
-    __repr__ = __str__
-
 
+@dataclass(frozen=True, slots=True, repr=False)
 class FunctionRule(RuleChecker):
-    """RuleChecker that keeps track of calls to a particular `function`."""
+    """RuleChecker for calls to a particular `function`."""
 
-    def __init__(self, ruletype: RuleType, function: str):
-        super().__init__(ruletype)
-        self.function = function
+    function: str
 
-    # Overrides ast.NodeVisitor.visit_Call
-    def visit_Call(self, node):
-        if isinstance(node.func, ast.Name) and node.func.id == self.function:
-            self.found_location = node.lineno
-        for e in node.args:
-            super().visit(e)
-        for e in node.keywords:
-            super().visit(e)
+    def __post_init__(self) -> None:
+        # Shares one string with equal names (pickling to a worker makes a new copy)
+        object.__setattr__(self, "function", sys.intern(self.function))
+        RuleChecker.__post_init__(self)
 
-    def __str__(self) -> str:
+    def _describe(self) -> str:
         return f"{self.ruletype.value}FunctionCall({self.function})"
 
-    __repr__ = __str__
-
 
+@dataclass(frozen=True, slots=True, repr=False)
 class NodeRule(RuleChecker):
     """
-    RuleChecker that keeps track of instances of a particular `node_type`.
+    RuleChecker for instances of a particular `node_type`.
 
-    NOTE: `node_type` must be an attribute of the ast module (one of its node types)
+    NOTE: `node_type` may be given as the name of one of the ast module's node types
     """
 
-    def __init__(self, ruletype: RuleType, node_type: str):
-        super().__init__(ruletype)
-        self.node_type = getattr(ast, node_type)
+    # Any, since it may be given as a str, which __post_init__ replaces with the type
+    node_type: Any
 
-    # Overrides ast.NodeVisitor.visit
-    def visit(self, node):
-        if isinstance(node, self.node_type):
-            self.found_location = node.lineno
-        super().visit(node)
+    def __post_init__(self) -> None:
+        if isinstance(self.node_type, str):
+            object.__setattr__(self, "node_type", getattr(ast, self.node_type))
+        # zero-argument super() doesn't work in slotted dataclasses
+        RuleChecker.__post_init__(self)
 
-    def __str__(self) -> str:
+    def _describe(self) -> str:
         return f"{self.ruletype.value}{self.node_type.__name__}"
 
-    __repr__ = __str__
+
+# Small, since each tree is far larger than its source (~94 KB for a 1.5 KB file)
+@functools.lru_cache(maxsize=16)
+def _parse(code: str | bytes) -> ast.Module:
+    """
+    Parses `code`. Memoizes the last few files, so a file identical to one just
+    checked (e.g. untouched starter code) isn't parsed again.
+    """
+    return ast.parse(code)
+
+
+def _newline_offsets(source: bytes, last_line: int) -> list[int]:
+    """
+    Returns the offsets of the line breaks in `source`, up to the end of line
+    `last_line` since later lines aren't needed. Like the tokenizer, `\r\n`, `\r`
+    and `\n` are all line breaks; the offset of a `\r\n` is that of its `\n`.
+    """
+    # Vectorized byte compare, instead of searching for each newline in turn
+    buf = np.frombuffer(source, dtype=np.uint8)
+    breaks = buf == 0x0A
+    lone_cr = buf == 0x0D
+    lone_cr[:-1] &= buf[1:] != 0x0A
+    breaks |= lone_cr
+    return np.flatnonzero(breaks)[:last_line].tolist()
 
 
-def find_violations(code: str, rules: list[RuleChecker]) -> list[RuleViolation]:
+def _get_line(source: bytes, newlines: list[int], line_num: int) -> Optional[str]:
     """
-    Finds any violations of `rules` in `code`, by having each RuleChecker
-    visit the AST of `code`.
+    Returns line `line_num` of `source`, given the offsets of its `newlines`,
+    or None if `source` has no such line.
+    """
+    if line_num - 2 >= len(newlines):
+        return None
+    start = newlines[line_num - 2] + 1 if line_num > 1 else 0
+    end = newlines[line_num - 1] if line_num <= len(newlines) else len(source)
+    # utf-8-sig drops the byte order mark some editors put at the start of a file
+    return source[start:end].decode("utf-8-sig", errors="replace").rstrip()
+
+
+def _node_classes(node_type: type) -> list[type]:
+    """
+    Returns `node_type` and all of its subclasses: every class of node that is an
+    instance of `node_type`. Skips the deprecated aliases (e.g. `Num`), which the
+    parser never produces.
+    """
+    classes = [node_type]
+    subclass: type
+    for subclass in node_type.__subclasses__():
+        if type(subclass) is type:
+            classes += _node_classes(subclass)
+    return classes
+
+
+# Nodes of these classes never occur inside an expression
+_STATEMENT_LEVEL = (
+    ast.mod,
+    ast.stmt,
+    ast.excepthandler,
+    ast.match_case,
+    ast.pattern,
+    ast.withitem,
+    ast.alias,
+    ast.type_ignore,
+)
+
+
+class _RuleIndex(NamedTuple):
+    """A set of rules bucketed by what they match, built by `_index_rules`."""
+
+    node_rules: dict[type, list[NodeRule]]
+    func_rules: dict[str, list[FunctionRule]]
+    method_rules: dict[str, list[MethodRule]]
+    # Rules for deprecated aliases (e.g. `Num`), which match Constants by value
+    # and so have to be checked with isinstance
+    isinstance_rules: tuple[NodeRule, ...]
+    # The rules in their original order, without duplicates
+    unique_rules: tuple[RuleChecker, ...]
+    # Rules that can match a node inside an expression
+    expr_rules: frozenset[RuleChecker]
+
+
+@functools.lru_cache(maxsize=256)
+def _index_rules(rules: tuple[RuleChecker, ...]) -> _RuleIndex:
+    """
+    Buckets `rules` by what they match, so `find_violations` can dispatch each node
+    only to the rules interested in it. Cached, since every file for a problem is
+    checked against the same rules. Equal rules (e.g. the same rule both in the
+    universal rules and a problem's) are only indexed once.
+
+    NodeRules are registered under every concrete class of their node type, so
+    rules for abstract types like `stmt` also match with a lookup by exact type.
+    """
+    node_rules: dict[type, list[NodeRule]] = {}
+    func_rules: dict[str, list[FunctionRule]] = {}
+    method_rules: dict[str, list[MethodRule]] = {}
+    isinstance_rules: list[NodeRule] = []
+    expr_rules: set[RuleChecker] = set()
+    # Rules are equal when they have the same class, RuleType and target
+    unique_rules = tuple(dict.fromkeys(rules))
+    for rule in unique_rules:
+        if isinstance(rule, NodeRule):
+            if type(rule.node_type) is not type:
+                isinstance_rules.append(rule)
+                expr_rules.add(rule)
+                continue
+            for node_class in _node_classes(rule.node_type):
+                node_rules.setdefault(node_class, []).append(rule)
+                if not issubclass(node_class, _STATEMENT_LEVEL):
+                    expr_rules.add(rule)
+        elif isinstance(rule, FunctionRule):
+            func_rules.setdefault(rule.function, []).append(rule)
+            expr_rules.add(rule)
+        elif isinstance(rule, MethodRule):
+            method_rules.setdefault(rule.method, []).append(rule)
+            expr_rules.add(rule)
+
+    return _RuleIndex(
+        node_rules,
+        func_rules,
+        method_rules,
+        tuple(isinstance_rules),
+        unique_rules,
+        frozenset(expr_rules),
+    )
+
+
+def find_violations(
+    code: str | bytes, rules: Sequence[RuleChecker]
+) -> list[RuleViolation]:
+    """
+    Finds any violations of `rules` in `code`, checking every rule in a single
+    walk over the AST of `code`. `code` may be raw bytes read from a source file.
+    Duplicate rules are only checked, and reported, once.
     Returns a list of any such violations found, as list[RuleViolation]
     """
     try:
-        tree = ast.parse(code)
+        tree = _parse(code)
     except SyntaxError:
         return []
 
-    for rulechecker in rules:
-        rulechecker.reset()
-        rulechecker.visit(tree)
-
-    violations = (rule.get_violation() for rule in rules)
-    violations = [v for v in violations if v is not None]
-    # Add lines of code to RuleViolations
-    code_lines = [line.rstrip() for line in code.splitlines()]
-    code_lines.insert(0, None) # make list indices correspond to line nums
-    for violation in violations:
-        if violation.line_num:
-            violation.line = code_lines[violation.line_num]
+    # The walk removes buckets from its copy of the index as they are matched
+    index = _index_rules(tuple(rules))
+    node_rules = dict(index.node_rules)
+    func_rules = dict(index.func_rules)
+    method_rules = dict(index.method_rules)
+    isinstance_rules = list(index.isinstance_rules)
+    isinstance_types = tuple({rule.node_type for rule in isinstance_rules})
+
+    # Only the first match of a rule matters, so matched buckets are dropped, rules
+    # already found (e.g. under another node class) are skipped, and the walk
+    # stops once every rule has been found. Once no rule left can match inside an
+    # expression, expressions' subtrees are skipped too.
+    found: dict[RuleChecker, int] = {}
+    remaining = len(index.unique_rules)
+    expr_remaining = len(index.expr_rules)
+    # Depth-first in field order, which is only roughly source order (a function's
+    # decorators and return annotation come after its body, an IfExp's test before
+    # its body), so the first match is usually, not always, the earliest in the file
+    # Any, since only some node classes have a lineno
+    stack: list[Any] = [tree]
+    # Local names, since these are looked up for every node
+    pop, push = stack.pop, stack.append
+    Call, Name, Attribute = ast.Call, ast.Name, ast.Attribute
+    AST, expr = ast.AST, ast.expr
+    while stack:
+        node = pop()
+        # The parser only creates exact node classes, so compare types by identity
+        cls = type(node)
+        matched: Sequence[RuleChecker] = node_rules.pop(cls, ())
+        if cls is Call:
+            func = node.func
+            if type(func) is Name and func.id in func_rules:
+                matched = (*matched, *func_rules.pop(func.id))
+        elif cls is Attribute and node.attr in method_rules:
+            matched = (*matched, *method_rules.pop(node.attr))
+        if isinstance_types and isinstance(node, isinstance_types):
+            matched = (
+                *matched,
+                *(r for r in isinstance_rules if isinstance(node, r.node_type)),
+            )
+            isinstance_rules = [r for r in isinstance_rules if r not in matched]
+            isinstance_types = tuple({rule.node_type for rule in isinstance_rules})
+
+        if matched:
+            for rule in matched:
+                if rule not in found:
+                    found[rule] = node.lineno
+                    remaining -= 1
+                    if rule in index.expr_rules:
+                        expr_remaining -= 1
+            if not remaining:
+                break
+
+        if expr_remaining or not isinstance(node, expr):
+            # Same as ast.iter_child_nodes (reversed), without its nested generators
+            for name in reversed(node._fields):
+                child = getattr(node, name, None)
+                if type(child) is list:
+                    stack += [item for item in reversed(child) if isinstance(item, AST)]
+                elif isinstance(child, AST):
+                    push(child)
+
+    violations = [
+        violation
+        for rule in index.unique_rules
+        if (violation := rule.get_violation(found.get(rule))) is not None
+    ]
+    # Add lines of code to RuleViolations, only looking up the lines needed
+    line_nums = [v.line_num for v in violations if v.line_num is not None]
+    if line_nums:
+        source = code.encode() if isinstance(code, str) else code
+        newlines = _newline_offsets(source, max(line_nums))
+        violations = [
+            v._replace(line=_get_line(source, newlines, v.line_num))
+            if v.line_num is not None
+            else v
+            for v in violations
+        ]
 
     return violations
 
 
-def main():
+def _check_file(filename: str, rules: Sequence[RuleChecker]) -> list[RuleViolation]:
+    """Returns the violations of `rules` in the file `filename`, in a worker process."""
+    with open(filename, "rb") as f:
+        return find_violations(f.read(), rules)
+
+
+def find_violations_batch(
+    files: Sequence[str], rules: Sequence[RuleChecker]
+) -> dict[str, list[RuleViolation]]:
+    """
+    Checks each of `files` against `rules` in a pool of worker processes, since
+    parsing and walking are CPU bound. Returns the violations for each file.
+    """
+    rules = tuple(rules)
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            _check_file,
+            files,
+            itertools.repeat(rules),
+            chunksize=max(1, len(files) // (4 * (os.cpu_count() or 1))),
+        )
+        return dict(zip(files, results))
+
+
+def main() -> None:
     rules = [
         NodeRule(RuleType.BAN, "For"),
         NodeRule(RuleType.BAN, "While"),
@@ -200,13 +437,24 @@ def main():
         MethodRule(RuleType.BAN, "join"),
     ]
 
-    filename = input("enter file to check: ")
-    code = open(filename).read()
-    violations = ic(find_violations(code, rules))
-    if len(violations) == 0:
-        print("all rules followed.")
+    filenames = sys.argv[1:] or [input("enter file to check: ")]
+    if len(filenames) == 1:
+        with open(filenames[0], "rb") as f:
+            all_violations = {filenames[0]: find_violations(f.read(), rules)}
     else:
-        print(*violations, sep="\n")
+        all_violations = find_violations_batch(filenames, rules)
+    if DEBUG:
+        # Only imported when debugging, since icecream is slow to import
+        from icecream import ic
+
+        ic(all_violations)
+    for filename, violations in all_violations.items():
+        if len(filenames) > 1:
+            print(f"{filename}:")
+        if len(violations) == 0:
+            print("all rules followed.")
+        else:
+            print(*violations, sep="\n")
 
 
 if __name__ == "__main__":
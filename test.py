@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def concat_elements(slist, startpos, stoppos):
     if startpos > stoppos:
         slist = []
@@ -6,13 +9,14 @@ def concat_elements(slist, startpos, stoppos):
     if startpos < 0:
         startpos = 0
 
-    new_string = ""
-    while startpos <= stoppos:
-        new_string += str(slist[startpos])
-        startpos += 1
+    if startpos > stoppos:
+        return ""
 
-    return new_string
+    return "".join(map(str, slist[startpos : stoppos + 1]))
 
 
 def get_evens(lst):
+    arr = np.asarray(lst)
+    if arr.dtype.kind in "iu":
+        return arr[(arr & 1) == 0].tolist()
     return [x for x in lst if x % 2 == 0]